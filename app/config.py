@@ -7,5 +7,9 @@ class Settings:
     REDIS_HOST: str = os.getenv("REDIS_HOST", "localhost")
     REDIS_PORT: int = int(os.getenv("REDIS_PORT", 6379))
     REDIS_DB: int = int(os.getenv("REDIS_DB", 0))
+    # upper bound on pooled sockets; tune to expected concurrent requests
+    REDIS_MAX_CONNECTIONS: int = int(os.getenv("REDIS_MAX_CONNECTIONS", 64))
+    # when set (co-located Redis), connect over the unix socket instead of TCP
+    REDIS_UNIX_SOCKET_PATH: str = os.getenv("REDIS_UNIX_SOCKET_PATH", "")
 
 settings = Settings()
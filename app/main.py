@@ -1,19 +1,32 @@
 from __future__ import annotations
 
-import json
+import asyncio
+import functools
 import logging
 import os
+import random
 import time
-import uuid
+import secrets
 import math
+import base64
+
+import orjson
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 from typing import Any, Dict, Optional, Tuple, List, Iterable
 
-from fastapi import FastAPI, HTTPException, Request, Body, Query
+from fastapi import FastAPI, HTTPException, Request, Body, Query, Response
 
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
 
-from app.redis_client import redis_client, close_redis
+from redis.exceptions import NoScriptError, ResponseError
+
+from app.redis_client import redis_client, close_redis, HIREDIS_AVAILABLE
 
 from typing import Literal
 
@@ -24,6 +37,15 @@ from app.services.city import (
     accept_invite,
 )
 
+# Optional: libuv-backed event loop. Cuts per-await scheduling cost, which
+# this service pays constantly on redis_client calls and the UserLock retry
+# loop. Falls back to the default asyncio loop when uvloop is not installed.
+try:
+    import uvloop
+    uvloop.install()
+except ImportError:
+    uvloop = None
+
 
 # -----------------------------------------------------------------------------
 # Logging (readable + request-id)
@@ -38,13 +60,14 @@ logging.basicConfig(
 log = logging.getLogger("city-backend")
 
 
-def _client_ip(req: Request) -> str:
+def _client_ip(scope: Dict[str, Any]) -> str:
     # behind ALB/nginx use X-Forwarded-For
-    xff = req.headers.get("x-forwarded-for")
-    if xff:
-        return xff.split(",")[0].strip()
-    if req.client:
-        return req.client.host
+    for name, value in scope.get("headers") or ():
+        if name == b"x-forwarded-for":
+            return value.decode("latin-1").split(",")[0].strip()
+    client = scope.get("client")
+    if client:
+        return client[0]
     return "unknown"
 
 
@@ -54,6 +77,7 @@ def _client_ip(req: Request) -> str:
 LOCK_TTL_MS = int(os.getenv("USER_LOCK_TTL_MS", "8000"))
 LOCK_WAIT_MS = int(os.getenv("USER_LOCK_WAIT_MS", "2500"))
 LOCK_RETRY_SLEEP_MS = int(os.getenv("USER_LOCK_RETRY_SLEEP_MS", "35"))
+LOCK_RETRY_CAP_MS = int(os.getenv("USER_LOCK_RETRY_CAP_MS", "500"))
 
 _UNLOCK_LUA = """
 if redis.call("get", KEYS[1]) == ARGV[1] then
@@ -63,6 +87,54 @@ else
 end
 """
 
+# SHA1 of _UNLOCK_LUA, loaded once at startup so releases use EVALSHA
+# (40 bytes on the wire, no re-compile in redis-server) instead of EVAL.
+_UNLOCK_SHA: Optional[str] = None
+
+
+async def _unlock_eval(key: str, token: str) -> None:
+    global _UNLOCK_SHA
+    if _UNLOCK_SHA is None:
+        _UNLOCK_SHA = await redis_client.script_load(_UNLOCK_LUA)
+    try:
+        await redis_client.evalsha(_UNLOCK_SHA, 1, key, token)
+    except NoScriptError:
+        # Redis restarted / script cache flushed: re-load once and retry
+        _UNLOCK_SHA = await redis_client.script_load(_UNLOCK_LUA)
+        await redis_client.evalsha(_UNLOCK_SHA, 1, key, token)
+
+# Conditional charge + city store in one server-side step. The gold check is
+# re-done inside Redis so the debit and the blob write are atomic even if the
+# user lock expired mid-request (PX timeout): no double-spend window between
+# our validation read and the write batch, and one EVALSHA instead of a
+# two-command pipeline.
+_CHARGE_AND_SET_LUA = """
+local gold = tonumber(redis.call('HGET', KEYS[1], 'gold') or '0')
+local cost = tonumber(ARGV[1])
+if gold < cost then
+  return -1
+end
+redis.call('HSET', KEYS[1], 'gold', gold - cost)
+redis.call('SET', KEYS[2], ARGV[2])
+return 1
+"""
+
+_CHARGE_AND_SET_SHA: Optional[str] = None
+
+
+async def _charge_and_set_city(player_key: str, city_key: str, cost: float, blob: bytes) -> bool:
+    """Returns False when the player no longer has `cost` gold."""
+    global _CHARGE_AND_SET_SHA
+    if _CHARGE_AND_SET_SHA is None:
+        _CHARGE_AND_SET_SHA = await redis_client.script_load(_CHARGE_AND_SET_LUA)
+    try:
+        res = await redis_client.evalsha(_CHARGE_AND_SET_SHA, 2, player_key, city_key, str(float(cost)), blob)
+    except NoScriptError:
+        _CHARGE_AND_SET_SHA = await redis_client.script_load(_CHARGE_AND_SET_LUA)
+        res = await redis_client.evalsha(_CHARGE_AND_SET_SHA, 2, player_key, city_key, str(float(cost)), blob)
+    return int(res) == 1
+
+
 class ExpandGemsRequest(BaseModel):
     steps: int = 1
 
@@ -90,18 +162,43 @@ def _speedup_cost_gems(reduce_seconds: int) -> int:
 def _ledger_key(user_id: str) -> str:
     return f"ledger:{user_id}"
 
+async def _execute_with_ledger_migration(pipe, user_id: str, entry_b: bytes):
+    """
+    Run a payment write pipeline whose XADD may hit a legacy LPUSH ledger
+    list. Inside the MULTI a WRONGTYPE aborts only the XADD — the money
+    writes still commit and execute() raises afterwards — so on that error
+    the legacy list is renamed aside and just the ledger append is retried.
+    Same lazy-migration policy as the world/meta/invite layout changes.
+    """
+    try:
+        await pipe.execute()
+    except ResponseError as e:
+        if "WRONGTYPE" not in str(e):
+            raise
+        lkey = _ledger_key(user_id)
+        try:
+            await redis_client.rename(lkey, lkey + ":legacy")
+        except ResponseError:
+            pass  # raced with another migrator; the list is already gone
+        await redis_client.xadd(lkey, {"e": entry_b}, maxlen=1000, approximate=True)
+
 def _idempo_key(user_id: str, op: str, key: str) -> str:
     return f"idempo:{user_id}:{op}:{key}"
 
+@functools.lru_cache(maxsize=512)
 def _expand_cost_gems(current_radius: int, steps: int = 1) -> int:
     # simple non-linear growth, placeholder for monetization tuning
-    base = 10  # radius 3->4
+    # The per-step sum is a geometric series: `k` leading flat terms while
+    # the clamp max(0, rr-3) is active, then a geometric run from exponent
+    # r+k-3. Closed form = O(1) instead of O(steps).
+    base = 10.0  # radius 3->4
     r = max(0, int(current_radius))
     s = max(1, int(steps))
-    total = 0.0
-    for i in range(s):
-        rr = r + i
-        total += base * (1.55 ** max(0, rr - 3))
+    k = min(s, max(0, 3 - r))
+    m = s - k
+    total = base * k
+    if m:
+        total += base * (1.55 ** (r + k - 3)) * ((1.55 ** m) - 1.0) / 0.55
     return int(round(total))
 
 
@@ -109,17 +206,22 @@ class UserLock:
     def __init__(self, user_id: str):
         self.user_id = user_id
         self.key = f"lock:player:{user_id}"
-        self.token = uuid.uuid4().hex
+        self.token = secrets.token_hex(16)
         self.acquired = False
 
     async def __aenter__(self):
-        deadline = time.time() + (LOCK_WAIT_MS / 1000.0)
-        while time.time() < deadline:
+        # monotonic clock: immune to NTP wall-clock jumps during the wait loop
+        deadline = time.monotonic() + (LOCK_WAIT_MS / 1000.0)
+        # Exponential backoff with decorrelated jitter: a fixed retry interval
+        # makes all waiters hit Redis at the same tick (retry storms).
+        prev_ms = LOCK_RETRY_SLEEP_MS
+        while time.monotonic() < deadline:
             ok = await redis_client.set(self.key, self.token, nx=True, px=LOCK_TTL_MS)
             if ok:
                 self.acquired = True
                 return self
-            await _sleep_ms(LOCK_RETRY_SLEEP_MS)
+            prev_ms = min(LOCK_RETRY_CAP_MS, prev_ms * 2)
+            await asyncio.sleep(random.uniform(LOCK_RETRY_SLEEP_MS, prev_ms) / 1000.0)
 
         raise HTTPException(status_code=409, detail="Player is locked (try again).")
 
@@ -127,21 +229,18 @@ class UserLock:
         if not self.acquired:
             return
         try:
-            await redis_client.eval(_UNLOCK_LUA, 1, self.key, self.token)
+            await _unlock_eval(self.key, self.token)
         except Exception as e:
             # lock expires by TTL anyway; not fatal
             log.warning(f"lock release failed user={self.user_id} err={e}")
 
 
-async def _sleep_ms(ms: int) -> None:
-    import asyncio
-    await asyncio.sleep(ms / 1000.0)
-
-
 # -----------------------------------------------------------------------------
 # App
 # -----------------------------------------------------------------------------
-app = FastAPI(title="City Builder Backend", version="0.3.0")
+# orjson-backed responses: encodes the big city/world payloads several times
+# faster than stdlib json and writes bytes without an intermediate str.
+app = FastAPI(title="City Builder Backend", version="0.3.0", default_response_class=ORJSONResponse)
 
 
 # -----------------------------------------------------------------------------
@@ -166,23 +265,58 @@ app.add_middleware(
 )
 
 
-# Request logging middleware (rid, ip, ms, status)
-@app.middleware("http")
-async def request_logger(request: Request, call_next):
-    rid = str(uuid.uuid4())
-    request.state.rid = rid
-    ip = _client_ip(request)
-    t0 = time.time()
-    status = 500
+# Request logging middleware (rid, ip, ms, status).
+# Pure ASGI class on purpose: the @app.middleware("http") decorator goes
+# through BaseHTTPMiddleware, which spawns an extra task + anyio stream pair
+# per request. Wrapping the ASGI callable directly skips all of that.
+class RequestLoggerMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        rid = secrets.token_hex(16)
+        # Request.state is backed by scope["state"], so handlers keep
+        # reading req.state.rid as before
+        scope.setdefault("state", {})["rid"] = rid
+        ip = _client_ip(scope)
+        t0 = time.perf_counter()
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            dt_ms = (time.perf_counter() - t0) * 1000.0
+            # placeholder form: the line is only formatted if INFO is emitted
+            log.info(
+                "rid=%s ip=%s %s %s status=%d %.1fms",
+                rid, ip, scope["method"], scope["path"], status, dt_ms,
+            )
+
+
+app.add_middleware(RequestLoggerMiddleware)
+
+
+@app.on_event("startup")
+async def startup_event():
+    global _UNLOCK_SHA, _CHARGE_AND_SET_SHA
+    if not HIREDIS_AVAILABLE:
+        log.warning("hiredis not installed; falling back to the pure-Python RESP parser")
     try:
-        resp = await call_next(request)
-        status = resp.status_code
-        return resp
-    finally:
-        dt_ms = (time.time() - t0) * 1000.0
-        log.info(
-            f"rid={rid} ip={ip} {request.method} {request.url.path} status={status} {dt_ms:.1f}ms"
-        )
+        _UNLOCK_SHA = await redis_client.script_load(_UNLOCK_LUA)
+        _CHARGE_AND_SET_SHA = await redis_client.script_load(_CHARGE_AND_SET_LUA)
+    except Exception as e:
+        # not fatal: both call sites lazily load their script on first use
+        log.warning(f"script preload failed err={e}")
 
 
 @app.on_event("shutdown")
@@ -266,6 +400,102 @@ BUILDING_CONFIG: Dict[str, Dict[str, Any]] = {
 
 DEFAULT_RESOURCES = {"gold": 500.0, "wood": 300.0, "gems": 0}
 
+
+# -----------------------------------------------------------------------------
+# City blob wire format
+# -----------------------------------------------------------------------------
+# CITY_BLOB_FORMAT=msgpack roughly halves the stored payload vs JSON and
+# decodes faster; reads auto-detect the format via a sentinel prefix, so
+# existing JSON blobs keep loading and cities migrate lazily on next write.
+# The msgpack body stays base64-wrapped for compatibility with blobs that
+# were written while the client still decoded replies as UTF-8 text.
+CITY_BLOB_FORMAT = os.getenv("CITY_BLOB_FORMAT", "json").strip().lower()
+if CITY_BLOB_FORMAT == "msgpack" and msgpack is None:
+    log.warning("CITY_BLOB_FORMAT=msgpack but msgpack is not installed; using json")
+    CITY_BLOB_FORMAT = "json"
+
+_MSGPACK_PREFIX = "mp1:"
+_MSGPACK_PREFIX_B = _MSGPACK_PREFIX.encode()
+
+# Stored blobs are stamped with the schema version they were written under.
+# Reads of a current-version blob skip the O(N buildings) normalization pass
+# entirely; legacy/unstamped blobs normalize once and re-save stamped.
+SCHEMA_VERSION = 1
+
+
+def _next_upgrade_end(buildings: Dict[str, Any]) -> float:
+    """Earliest pending upgrade_end, or 0.0 when no upgrade is running."""
+    ne = 0.0
+    for b in buildings.values():
+        ue = b.get("upgrade_end")
+        if ue:
+            ue = float(ue)
+            if ne == 0.0 or ue < ne:
+                ne = ue
+    return ne
+
+
+def _dumps_city(buildings: Dict[str, Any], occ: Optional[frozenset] = None) -> bytes:
+    # the packed occupied-tile set and the next-upgrade-end stamp ride
+    # along in the envelope: the collision check never rebuilds the set
+    # from N buildings, and readers skip the finish-upgrades walk while
+    # now < ne; writers that did not track occ recompute it here
+    if occ is None:
+        occ = _occupied_tiles_packed(buildings)
+    envelope = {"_v": SCHEMA_VERSION, "b": buildings, "occ": sorted(occ), "ne": _next_upgrade_end(buildings)}
+    if CITY_BLOB_FORMAT == "msgpack":
+        packed = msgpack.packb(envelope, use_bin_type=True)
+        return _MSGPACK_PREFIX.encode() + base64.b64encode(packed)
+    return orjson.dumps(envelope)
+
+
+def _loads_city(raw: Any) -> Dict[str, Any]:
+    if isinstance(raw, str):
+        raw = raw.encode()
+    if raw.startswith(_MSGPACK_PREFIX_B):
+        if msgpack is None:
+            # RuntimeError, not ValueError: decode errors are treated as
+            # corrupt-blob by _decode_city_state, and a missing optional
+            # dependency must never be mistaken for one
+            raise RuntimeError("city blob is msgpack but msgpack is not installed")
+        return msgpack.unpackb(base64.b64decode(raw[len(_MSGPACK_PREFIX_B):]), raw=False)
+    return orjson.loads(raw)
+
+
+def _decode_city_state(raw: Any) -> Tuple[Dict[str, Dict[str, Any]], Optional[frozenset], Optional[float], bool]:
+    """
+    Decode a stored city blob into (buildings, occ, ne, migrated).
+    Blobs written by the current SCHEMA_VERSION are trusted as canonical
+    and returned without normalization; anything else (legacy shape,
+    corrupt data) runs the full _normalize_buildings pass and reports
+    migrated=True so the caller re-saves it stamped.
+    occ is the persisted packed-tile set and ne the next-upgrade-end
+    stamp (0.0 = nothing running); either is None when the blob predates
+    it, and callers fall back to the full recompute/walk.
+    """
+    try:
+        blob = _loads_city(raw)
+    except RuntimeError:
+        # msgpack blob on a process without msgpack: decoding to {} here
+        # would make the caller re-save an empty stamped city over the
+        # real data, so fail the request instead
+        raise
+    except Exception:
+        blob = {}
+    if isinstance(blob, dict) and blob.get("_v") == SCHEMA_VERSION and isinstance(blob.get("b"), dict):
+        occ_raw = blob.get("occ")
+        occ = frozenset(int(t) for t in occ_raw) if isinstance(occ_raw, list) else None
+        ne_raw = blob.get("ne")
+        ne = float(ne_raw) if isinstance(ne_raw, (int, float)) else None
+        return blob["b"], occ, ne, False
+    buildings, _ = _normalize_buildings(blob if isinstance(blob, dict) else {})
+    return buildings, None, None, True
+
+
+def _decode_city_buildings(raw: Any) -> Tuple[Dict[str, Dict[str, Any]], bool]:
+    buildings, _occ, _ne, migrated = _decode_city_state(raw)
+    return buildings, migrated
+
 def _build_catalog() -> Dict[str, Any]:
     """
     Returns a frontend-friendly catalog derived from BUILDING_CONFIG.
@@ -290,6 +520,11 @@ def _build_catalog() -> Dict[str, Any]:
     return catalog
 
 
+# BUILDING_CONFIG is static for the process lifetime, so the catalog is frozen
+# once at import instead of rebuilt per request. Read-only: must not be mutated.
+_CATALOG = _build_catalog()
+
+
 
 # =============================================================================
 # Pydantic requests
@@ -378,29 +613,134 @@ def _default_world() -> Dict[str, Any]:
 
 
 async def _load_world(city_id: str) -> Dict[str, Any]:
-    raw = await redis_client.get(_world_key(city_id))
-    if not raw:
+    """
+    World lives in a Redis HASH (radius / anchor / created_at fields):
+    no JSON encode/decode per request and partial updates (e.g. radius
+    bump on expand) are O(1) server-side instead of a full blob rewrite.
+    """
+    world_key = _world_key(city_id)
+    try:
+        h = await redis_client.hgetall(world_key)
+    except ResponseError:
+        # legacy JSON-string world blob: migrate to hash once
+        raw = await redis_client.get(world_key)
+        try:
+            old = orjson.loads(raw) if raw else {}
+            if not isinstance(old, dict):
+                old = {}
+        except Exception:
+            old = {}
         w = _default_world()
-        await redis_client.set(_world_key(city_id), json.dumps(w))
+        for k in ("radius", "anchor", "created_at", "updated_at"):
+            if k in old:
+                w[k] = old[k]
+        w["radius"] = _safe_int(w.get("radius"), DEFAULT_WORLD_RADIUS)
+        # atomic: a reader must never observe the world key deleted
+        pipe = redis_client.pipeline(transaction=True)
+        pipe.delete(world_key)
+        pipe.hset(world_key, mapping=w)
+        await pipe.execute()
         return w
-    try:
-        w = json.loads(raw)
-        if not isinstance(w, dict):
-            raise ValueError("world not dict")
-    except Exception:
+
+    if not h:
         w = _default_world()
-        await redis_client.set(_world_key(city_id), json.dumps(w))
+        await redis_client.hset(world_key, mapping=w)
         return w
 
-    # normalize
-    if "radius" not in w:
-        w["radius"] = DEFAULT_WORLD_RADIUS
-    w["radius"] = int(w.get("radius") or DEFAULT_WORLD_RADIUS)
-    if "anchor" not in w:
-        w["anchor"] = "topleft"
+    return _parse_world_hash(h)
+
+
+def _parse_world_hash(h: Dict[Any, Any]) -> Dict[str, Any]:
+    # normalize (the client returns raw bytes; keys decode once here and
+    # values go straight through the int/float coercions, which take bytes)
+    if h and isinstance(next(iter(h)), bytes):
+        h = {k.decode(): v for k, v in h.items()}
+    anchor = h.get("anchor")
+    if isinstance(anchor, bytes):
+        anchor = anchor.decode()
+    w: Dict[str, Any] = {
+        "radius": _safe_int(h.get("radius"), DEFAULT_WORLD_RADIUS),
+        "anchor": anchor or "topleft",
+    }
+    if h.get("created_at") is not None:
+        w["created_at"] = _safe_float(h.get("created_at"), 0.0)
+    if h.get("updated_at") is not None:
+        w["updated_at"] = _safe_float(h.get("updated_at"), 0.0)
     return w
 
 
+# Fixed field order for HMGET on the player hash. HMGET returns a flat list
+# (no dict build, no decoding of fields we never read) and stays O(1) if the
+# hash later grows extra per-player counters.
+_RESOURCE_FIELDS = ("gold", "wood", "gems", "last_collect")
+
+
+def _resources_or_none(vals: Any) -> Optional[Tuple[Any, Any, Any, Any]]:
+    """HMGET on a missing key yields all-None; map that to None (player not found)."""
+    gold_b, wood_b, gems_b, lc_b = vals
+    if gold_b is None and lc_b is None:
+        return None
+    return gold_b, wood_b, gems_b, lc_b
+
+
+async def _load_player_state(user_id: str, city_id: str) -> Tuple[Optional[Tuple[Any, Any, Any, Any]], Optional[str], Dict[str, Any], bool]:
+    """
+    Loads player resources + city blob + world hash in a single pipelined
+    round-trip instead of three sequential awaits (one RTT instead of 3).
+    Returns (resources_raw, buildings_raw, world, world_created) where
+    resources_raw is the (gold, wood, gems, last_collect) reply tuple, or
+    None when the player does not exist.
+
+    A missing world is NOT written back here: the caller batches that
+    hset into its own store-back pipeline, so the create costs no extra
+    round-trip (world_created=True signals it).
+    """
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.hmget(_player_key(user_id), *_RESOURCE_FIELDS)
+    pipe.get(_city_key(city_id))
+    pipe.hgetall(_world_key(city_id))
+    resources_raw, buildings_raw, world_raw = await pipe.execute(raise_on_error=False)
+
+    if isinstance(resources_raw, Exception):
+        raise resources_raw
+    resources_raw = _resources_or_none(resources_raw)
+    if isinstance(buildings_raw, Exception):
+        raise buildings_raw
+
+    world_created = False
+    if isinstance(world_raw, Exception):
+        # legacy string world (WRONGTYPE): slow path migrates in place
+        world = await _load_world(city_id)
+    elif not world_raw:
+        world = _default_world()
+        world_created = True
+    else:
+        world = _parse_world_hash(world_raw)
+
+    return resources_raw, buildings_raw, world, world_created
+
+
+async def _load_player_world(user_id: str, city_id: str) -> Tuple[Optional[Tuple[Any, Any, Any, Any]], Dict[str, Any]]:
+    """
+    Like _load_player_state but without the city blob, for endpoints that
+    only touch resources + world (expand paths). One pipelined round-trip.
+    """
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.hmget(_player_key(user_id), *_RESOURCE_FIELDS)
+    pipe.hgetall(_world_key(city_id))
+    resources_raw, world_raw = await pipe.execute(raise_on_error=False)
+
+    if isinstance(resources_raw, Exception):
+        raise resources_raw
+    resources_raw = _resources_or_none(resources_raw)
+    if isinstance(world_raw, Exception) or not world_raw:
+        world = await _load_world(city_id)
+    else:
+        world = _parse_world_hash(world_raw)
+
+    return resources_raw, world
+
+
 def _world_bounds(radius: int) -> Tuple[int, int, int, int]:
     # returns min_x, max_x, min_y, max_y (inclusive)
     return (-radius, radius, -radius, radius)
@@ -417,8 +757,7 @@ def _is_inside_world(x: int, y: int, world: Dict[str, Any]) -> bool:
 # =============================================================================
 # === NEW: footprint helpers (currently 1x1, but ready for bigger) ============
 # =============================================================================
-def _get_footprint_for_type(b_type: str) -> Tuple[int, int]:
-    cfg = BUILDING_CONFIG.get(b_type, {})
+def _footprint_from_cfg(cfg: Dict[str, Any]) -> Tuple[int, int]:
     fp = cfg.get("footprint") or {"w": 1, "h": 1}
     w = int(fp.get("w") or 1)
     h = int(fp.get("h") or 1)
@@ -429,18 +768,40 @@ def _get_footprint_for_type(b_type: str) -> Tuple[int, int]:
     return w, h
 
 
+# Footprints resolved once at import (BUILDING_CONFIG is immutable at
+# runtime); the per-building hot paths then do a single dict lookup.
+_FP_BY_TYPE: Dict[str, Tuple[int, int]] = {
+    b_type: _footprint_from_cfg(cfg) for b_type, cfg in BUILDING_CONFIG.items()
+}
+
+
+def _get_footprint_for_type(b_type: str) -> Tuple[int, int]:
+    return _FP_BY_TYPE.get(b_type, (1, 1))
+
+
+# offset tables for small footprints, built once (covers up to 4x4; bigger
+# footprints fall back to computing offsets on the fly)
+_FP_OFFSETS: Dict[Tuple[int, int], Tuple[Tuple[int, int], ...]] = {
+    (w, h): tuple((dx, dy) for dx in range(w) for dy in range(h))
+    for w in range(1, 5)
+    for h in range(1, 5)
+}
+
+
 def _tiles_for_footprint(x: int, y: int, fp_w: int, fp_h: int, rotation: Optional[int] = None) -> List[Tuple[int, int]]:
     """
     Returns list of tiles occupied by a footprint.
     Current convention: x,y is the "top-left tile" of the footprint in world grid coords.
     Rotation is accepted but currently ignored (we treat all as not rotated).
     """
-    tiles: List[Tuple[int, int]] = []
     # future: apply rotation (swap w/h etc.)
-    for dx in range(fp_w):
-        for dy in range(fp_h):
-            tiles.append((x + dx, y + dy))
-    return tiles
+    if fp_w == 1 and fp_h == 1:
+        # dominant case today: skip the loop entirely
+        return [(x, y)]
+    offsets = _FP_OFFSETS.get((fp_w, fp_h))
+    if offsets is None:
+        offsets = tuple((dx, dy) for dx in range(fp_w) for dy in range(fp_h))
+    return [(x + dx, y + dy) for dx, dy in offsets]
 
 
 def _building_occupied_tiles(b: Dict[str, Any]) -> List[Tuple[int, int]]:
@@ -453,36 +814,63 @@ def _building_occupied_tiles(b: Dict[str, Any]) -> List[Tuple[int, int]]:
 
 
 def _footprint_fits_world(x: int, y: int, b_type: str, world: Dict[str, Any], rotation: Optional[int] = None) -> bool:
+    # footprints are solid axis-aligned rectangles, so containment reduces
+    # to comparing the two extreme corners against the square world bounds:
+    # O(1) integer arithmetic instead of materializing + testing every tile
+    if DEV_DISABLE_WORLD_BOUNDS:
+        return True
     fp_w, fp_h = _get_footprint_for_type(b_type)
-    tiles = _tiles_for_footprint(x, y, fp_w, fp_h, rotation)
-    return all(_is_inside_world(tx, ty, world) for (tx, ty) in tiles)
+    r = int(world.get("radius") or DEFAULT_WORLD_RADIUS)
+    return -r <= x and x + fp_w - 1 <= r and -r <= y and y + fp_h - 1 <= r
+
+
+# Tiles are packed into a single int for collision checks: int hashing is
+# considerably cheaper than tuple hashing and the occupied set is built once
+# per placement instead of one set per existing building.
+_TILE_OFFSET = 1 << 15  # shifts negative world coords into positive range
+
+
+def _pack_tile(x: int, y: int) -> int:
+    return (x + _TILE_OFFSET) | ((y + _TILE_OFFSET) << 32)
+
+
+def _occupied_tiles_packed(buildings: Dict[str, Dict[str, Any]]) -> frozenset:
+    return frozenset(
+        _pack_tile(tx, ty)
+        for b in buildings.values()
+        for (tx, ty) in _building_occupied_tiles(b)
+    )
 
 
-def _footprint_collides(buildings: Dict[str, Dict[str, Any]], x: int, y: int, b_type: str, rotation: Optional[int] = None) -> bool:
+def _footprint_collides(occupied: frozenset, x: int, y: int, b_type: str, rotation: Optional[int] = None) -> bool:
     fp_w, fp_h = _get_footprint_for_type(b_type)
-    target = set(_tiles_for_footprint(x, y, fp_w, fp_h, rotation))
-    for b in buildings.values():
-        occ = set(_building_occupied_tiles(b))
-        if target.intersection(occ):
-            return True
-    return False
+    return any(
+        _pack_tile(tx, ty) in occupied
+        for (tx, ty) in _tiles_for_footprint(x, y, fp_w, fp_h, rotation)
+    )
 
 
 # =============================================================================
 # Existing normalization/migration helpers (kept, just extended)
 # =============================================================================
-def _normalize_building(building_id: str, b: Dict[str, Any]) -> Dict[str, Any]:
+def _normalize_building(building_id: str, b: Any) -> Tuple[Dict[str, Any], bool]:
     """
     Ensure every building has:
       - type, level, x, y, upgrade_start, upgrade_end
     Also keeps fields for future:
       - rotation
+    Returns (normalized, changed); changed is flipped only when a branch
+    actually rewrote a value, so callers don't need a deep dict compare.
+    Normalizes in place: the dict comes fresh off the decoder and is owned
+    by the calling endpoint, so there is nothing to defensively copy.
     """
-    out = dict(b) if isinstance(b, dict) else {}
+    changed = not isinstance(b, dict)
+    out = b if isinstance(b, dict) else {}
     b_type = out.get("type")
 
     # fallback: old objects might have id without type
     if not b_type:
+        changed = True
         if building_id.startswith("townhall"):
             b_type = "townhall"
         elif building_id.startswith("farm"):
@@ -495,34 +883,45 @@ def _normalize_building(building_id: str, b: Dict[str, Any]) -> Dict[str, Any]:
             b_type = "barracks"
         else:
             b_type = "townhall"
+        out["type"] = b_type
 
     cfg = BUILDING_CONFIG.get(b_type, BUILDING_CONFIG["townhall"])
 
-    out["type"] = b_type
-    out["level"] = int(out.get("level") or 1)
+    level = int(out.get("level") or 1)
+    if out.get("level") != level:
+        out["level"] = level
+        changed = True
 
     # position (now can be negative; no clamping)
-    out["x"] = int(out.get("x") if out.get("x") is not None else cfg.get("default_x", 0))
-    out["y"] = int(out.get("y") if out.get("y") is not None else cfg.get("default_y", 0))
-
-    # upgrade fields
-    out["upgrade_start"] = out.get("upgrade_start", None)
-    out["upgrade_end"] = out.get("upgrade_end", None)
-
-    # handle "" or 0 stored by mistake
-    if out["upgrade_start"] in ("", 0):
-        out["upgrade_start"] = None
-    if out["upgrade_end"] in ("", 0):
-        out["upgrade_end"] = None
+    x = int(out.get("x") if out.get("x") is not None else cfg.get("default_x", 0))
+    y = int(out.get("y") if out.get("y") is not None else cfg.get("default_y", 0))
+    if out.get("x") != x:
+        out["x"] = x
+        changed = True
+    if out.get("y") != y:
+        out["y"] = y
+        changed = True
+
+    # upgrade fields; handle "" or 0 stored by mistake
+    for field in ("upgrade_start", "upgrade_end"):
+        if field not in out:
+            out[field] = None
+            changed = True
+        elif out[field] in ("", 0):
+            out[field] = None
+            changed = True
 
     if "rotation" not in out or out["rotation"] is None:
         out["rotation"] = 0
-    
+        changed = True
+
     # attach footprint for FE contract (stored per building)
     fp_w, fp_h = _get_footprint_for_type(b_type)
-    out["footprint"] = {"w": fp_w, "h": fp_h}
+    if out.get("footprint") != {"w": fp_w, "h": fp_h}:
+        out["footprint"] = {"w": fp_w, "h": fp_h}
+        changed = True
 
-    return out
+    return out, changed
 
 
 def _normalize_buildings(buildings: Dict[str, Any]) -> Tuple[Dict[str, Dict[str, Any]], bool]:
@@ -532,11 +931,18 @@ def _normalize_buildings(buildings: Dict[str, Any]) -> Tuple[Dict[str, Dict[str,
         return {}, True
 
     for bid, b in buildings.items():
-        nb = _normalize_building(str(bid), b if isinstance(b, dict) else {})
-        out[str(bid)] = nb
-        if b != nb:
+        if not isinstance(bid, str):
+            bid = str(bid)
+            changed = True
+        nb, ch = _normalize_building(bid, b)
+        out[bid] = nb
+        if ch:
             changed = True
 
+    # nothing rewritten: hand back the decoder's own dict, skipping the
+    # rebuilt copy (callers re-encode only when changed is True)
+    if not changed:
+        return buildings, False
     return out, changed
 
 
@@ -545,7 +951,7 @@ def _normalize_buildings(buildings: Dict[str, Any]) -> Tuple[Dict[str, Dict[str,
 # =============================================================================
 def _default_city_buildings() -> Dict[str, Dict[str, Any]]:
     th = BUILDING_CONFIG["townhall"]
-    return {
+    buildings = {
         "townhall_0": {
             "type": "townhall",
             "level": 1,
@@ -556,23 +962,52 @@ def _default_city_buildings() -> Dict[str, Dict[str, Any]]:
             "rotation": None,
         }
     }
+    # normalize before use: stamped blobs skip _normalize_buildings on read,
+    # so the template must already carry the FE-contract fields
+    # (rotation 0, footprint)
+    return _normalize_buildings(buildings)[0]
+
+
+# Pre-serialized starting city, encoded once at import: new_game/dev_reset
+# pipe these bytes straight into SET instead of re-building and re-encoding
+# the same dict on every fresh player. The world hash stays dynamic
+# (created_at is per-player), so only the city blob is frozen here.
+_DEFAULT_BUILDINGS_BLOB = _dumps_city(_default_city_buildings())
+
+
+# SoA view of the static per-type tables, resolved once at import: the hot
+# paths index flat float tuples by level instead of re-walking the nested
+# BUILDING_CONFIG dict-of-lists and re-coercing on every request.
+# _BCFG[b_type] = (max_level, upgrade_cost_gold, upgrade_duration)
+_BCFG: Dict[str, Tuple[int, Tuple[float, ...], Tuple[float, ...]]] = {
+    b_type: (
+        int(cfg.get("max_level") or 1),
+        tuple(float(c) for c in cfg.get("upgrade_cost_gold") or (0.0,)),
+        tuple(float(d) for d in cfg.get("upgrade_duration") or (0.0,)),
+    )
+    for b_type, cfg in BUILDING_CONFIG.items()
+}
 
+# Flat production tables bound once at import: the per-building loop then
+# avoids the nested BUILDING_CONFIG dict lookups + len() on every iteration.
+_FARM_GOLD_RATES = tuple(float(v) for v in BUILDING_CONFIG["farm"]["production_per_hour_gold"])
+_FARM_MAX = len(_FARM_GOLD_RATES) - 1
+_LUMBER_WOOD_RATES = tuple(float(v) for v in BUILDING_CONFIG["lumbermill"]["production_per_hour_wood"])
+_LUMBER_MAX = len(_LUMBER_WOOD_RATES) - 1
 
-def _calc_production_per_hour(buildings: Dict[str, Dict[str, Any]]) -> Tuple[float, float]:
-    gold_ph = 0.0
-    wood_ph = 0.0
-    for b in buildings.values():
-        b_type = b.get("type")
-        level = int(b.get("level") or 1)
-
-        if b_type == "farm":
-            rates = BUILDING_CONFIG["farm"].get("production_per_hour_gold", [0])
-            gold_ph += float(rates[min(level - 1, len(rates) - 1)])
-        elif b_type == "lumbermill":
-            rates = BUILDING_CONFIG["lumbermill"].get("production_per_hour_wood", [0])
-            wood_ph += float(rates[min(level - 1, len(rates) - 1)])
 
-    return gold_ph, wood_ph
+def _calc_production_per_hour(buildings: Dict[str, Dict[str, Any]]) -> Tuple[float, float]:
+    gold_ph = sum(
+        _FARM_GOLD_RATES[min(int(b.get("level") or 1) - 1, _FARM_MAX)]
+        for b in buildings.values()
+        if b.get("type") == "farm"
+    )
+    wood_ph = sum(
+        _LUMBER_WOOD_RATES[min(int(b.get("level") or 1) - 1, _LUMBER_MAX)]
+        for b in buildings.values()
+        if b.get("type") == "lumbermill"
+    )
+    return float(gold_ph), float(wood_ph)
 
 
 def _finish_upgrades_if_due(now: float, buildings: Dict[str, Dict[str, Any]]) -> bool:
@@ -590,6 +1025,18 @@ def _finish_upgrades_if_due(now: float, buildings: Dict[str, Dict[str, Any]]) ->
 # =============================================================================
 # === NEW: resource helpers (supports DEV unlimited) ==========================
 # =============================================================================
+def _maybe_finish_upgrades(now: float, buildings: Dict[str, Dict[str, Any]], ne: Optional[float]) -> bool:
+    """
+    O(1) gate in front of _finish_upgrades_if_due using the blob's
+    next-upgrade-end stamp: skip the per-building walk entirely when
+    nothing is running (ne == 0.0) or nothing is due yet (now < ne).
+    ne=None (pre-stamp blob) always walks.
+    """
+    if ne is not None and (ne == 0.0 or now < ne):
+        return False
+    return _finish_upgrades_if_due(now, buildings)
+
+
 def _is_unlimited() -> bool:
     return bool(DEV_UNLIMITED_RESOURCES)
 
@@ -609,18 +1056,27 @@ def _charge_gold(cost: float, resources: Dict[str, Any]) -> None:
 # =============================================================================
 # Endpoints
 # =============================================================================
+# Everything in the root payload except the timestamp is fixed for the
+# process lifetime, so the JSON is encoded once at import and only the
+# timestamp is spliced in per request. This path gets hammered by
+# liveness probes; skipping the dict build + encode keeps it cheap.
+_ROOT_PREFIX = orjson.dumps({
+    "message": "City Builder Backend is running.",
+    "dev": {
+        "ALLOW_DEV_ENDPOINTS": bool(ALLOW_DEV_ENDPOINTS),
+        "DEV_UNLIMITED_RESOURCES": bool(DEV_UNLIMITED_RESOURCES),
+        "DEFAULT_WORLD_RADIUS": DEFAULT_WORLD_RADIUS,
+        "DEV_DISABLE_WORLD_BOUNDS": bool(DEV_DISABLE_WORLD_BOUNDS),
+    },
+})[:-1] + b',"timestamp":'
+
+
 @app.get("/")
 async def root():
-    return {
-        "message": "City Builder Backend is running.",
-        "timestamp": time.time(),
-        "dev": {
-            "ALLOW_DEV_ENDPOINTS": bool(ALLOW_DEV_ENDPOINTS),
-            "DEV_UNLIMITED_RESOURCES": bool(DEV_UNLIMITED_RESOURCES),
-            "DEFAULT_WORLD_RADIUS": DEFAULT_WORLD_RADIUS,
-            "DEV_DISABLE_WORLD_BOUNDS": bool(DEV_DISABLE_WORLD_BOUNDS),
-        },
-    }
+    return Response(
+        content=_ROOT_PREFIX + f"{time.time()}}}".encode(),
+        media_type="application/json",
+    )
 
 
 @app.post("/new_game")
@@ -628,7 +1084,7 @@ async def new_game(req: Request, body: NewGameRequest):
     """
     Creates a new player and returns user_id + initial state.
     """
-    user_id = body.user_id or f"u_{uuid.uuid4().hex[:10]}"
+    user_id = body.user_id or f"u_{secrets.token_hex(5)}"
     now = time.time()
 
     # initialize city + membership
@@ -654,10 +1110,10 @@ async def new_game(req: Request, body: NewGameRequest):
         buildings = _default_city_buildings()
         world = _default_world()
 
-        pipe = redis_client.pipeline()
+        pipe = redis_client.pipeline(transaction=False)
         pipe.hset(player_key, mapping=resources)
-        pipe.set(city_key, json.dumps(buildings))
-        pipe.set(world_key, json.dumps(world))
+        pipe.set(city_key, _DEFAULT_BUILDINGS_BLOB)
+        pipe.hset(world_key, mapping=world)
         await pipe.execute()
 
     log.info(f"rid={req.state.rid} new_game user_id={user_id}")
@@ -681,11 +1137,8 @@ async def get_city(req: Request, user_id: str):
     world_key = _world_key(city_id)
 
     async with UserLock(user_id):
-        resources_raw = await redis_client.hgetall(player_key)
-        buildings_raw = await redis_client.get(city_key)
-
-        # === NEW: world load/ensure
-        world = await _load_world(city_id)
+        # === NEW: single pipelined round-trip for player + city + world
+        resources_raw, buildings_raw, world, world_created = await _load_player_state(user_id, city_id)
         radius = int(world.get("radius") or DEFAULT_WORLD_RADIUS)
 
         created = False
@@ -698,11 +1151,12 @@ async def get_city(req: Request, user_id: str):
                 resources = {"gold": DEFAULT_RESOURCES["gold"], "wood": DEFAULT_RESOURCES["wood"], "gems": DEFAULT_RESOURCES["gems"], "last_collect": now}  
             created = True
         else:
+            gold_b, wood_b, gems_b, lc_b = resources_raw
             resources = {
-                "gold": _safe_float(resources_raw.get("gold"), DEFAULT_RESOURCES["gold"]),
-                "wood": _safe_float(resources_raw.get("wood"), DEFAULT_RESOURCES["wood"]),
-                "gems": _safe_int(resources_raw.get("gems"), DEFAULT_RESOURCES["gems"]),
-                "last_collect": _safe_float(resources_raw.get("last_collect"), now),
+                "gold": _safe_float(gold_b, DEFAULT_RESOURCES["gold"]),
+                "wood": _safe_float(wood_b, DEFAULT_RESOURCES["wood"]),
+                "gems": _safe_int(gems_b, DEFAULT_RESOURCES["gems"]),
+                "last_collect": _safe_float(lc_b, now),
             }
             if _is_unlimited():
                 resources["gold"] = max(float(resources["gold"]), DEV_DEFAULT_GOLD)
@@ -712,18 +1166,15 @@ async def get_city(req: Request, user_id: str):
         # init city
         if not buildings_raw:
             buildings = _default_city_buildings()
+            ne = 0.0
             created = True
         else:
-            try:
-                buildings_loaded = json.loads(buildings_raw)
-            except Exception:
-                buildings_loaded = {}
-            buildings, migrated = _normalize_buildings(buildings_loaded)
+            buildings, _occ, ne, migrated = _decode_city_state(buildings_raw)
             if migrated:
                 created = True
 
         # finish upgrades
-        updated = _finish_upgrades_if_due(now, buildings)
+        updated = _maybe_finish_upgrades(now, buildings, ne)
 
         # idle production
         gold_ph, wood_ph = _calc_production_per_hour(buildings)
@@ -736,22 +1187,29 @@ async def get_city(req: Request, user_id: str):
             resources["wood"] = float(resources["wood"]) + elapsed_hours * wood_ph
         resources["last_collect"] = now
 
-        # store back (atomic batch)
-        pipe = redis_client.pipeline()
-        pipe.hset(
-            player_key,
-            mapping={
-                "gold": resources["gold"],
-                "wood": resources["wood"],
-                "gems": resources["gems"],
-                "last_collect": resources["last_collect"],
-            },
-        )
-        if updated or created:
-            pipe.set(city_key, json.dumps(buildings))
-        # world is ensured by _load_world; still keep it up-to-date if missing
-        pipe.set(world_key, json.dumps(world))
-        await pipe.execute()
+        # store back (atomic batch) — only the keys that actually changed.
+        # In unlimited mode with no finished upgrade and an existing world
+        # this is a pure read: no pipeline, no JSON encode, zero writes.
+        dirty_player = created or (not _is_unlimited() and elapsed_hours > 0.0)
+        dirty_city = updated or created
+        if dirty_player or dirty_city or world_created:
+            # idempotent writes under the user lock: no MULTI/EXEC wrapper
+            pipe = redis_client.pipeline(transaction=False)
+            if dirty_player:
+                pipe.hset(
+                    player_key,
+                    mapping={
+                        "gold": resources["gold"],
+                        "wood": resources["wood"],
+                        "gems": resources["gems"],
+                        "last_collect": resources["last_collect"],
+                    },
+                )
+            if dirty_city:
+                pipe.set(city_key, _dumps_city(buildings))
+            if world_created:
+                pipe.hset(world_key, mapping=world)
+            await pipe.execute()
 
         if DEBUG_DUMP:
             min_x, max_x, min_y, max_y = _world_bounds(radius)
@@ -771,15 +1229,22 @@ async def get_city(req: Request, user_id: str):
         "anchor": world.get("anchor", "topleft"),
     }
 
-    return {
+    payload = {
         "user_id": user_id,
         "resources": {"gold": round(float(resources["gold"]), 2), "wood": round(float(resources["wood"]), 2), "gems": int(resources["gems"])},
         "buildings": buildings,
         "world": world_payload,
-        "catalog": _build_catalog(),
+        "catalog": _CATALOG,
         "server_time": now,
     }
 
+    # big cities serialize off the event loop so one whale's GET does not
+    # stall everyone else's handlers; small payloads skip the thread hop
+    if len(buildings) > 64:
+        body = await asyncio.to_thread(orjson.dumps, payload)
+        return Response(content=body, media_type="application/json")
+    return payload
+
 
 @app.post("/city/{user_id}/upgrade")
 async def upgrade_building(req: Request, user_id: str, request: UpgradeRequest):
@@ -802,28 +1267,28 @@ async def upgrade_building(req: Request, user_id: str, request: UpgradeRequest):
     city_key = _city_key(city_id)
 
     async with UserLock(user_id):
-        buildings_raw = await redis_client.get(city_key)
-        resources_raw = await redis_client.hgetall(player_key)
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.get(city_key)
+        pipe.hmget(player_key, *_RESOURCE_FIELDS)
+        buildings_raw, resources_raw = await pipe.execute()
+        resources_raw = _resources_or_none(resources_raw)
 
         if not buildings_raw or not resources_raw:
             raise HTTPException(status_code=404, detail="Player not found")
 
-        try:
-            buildings_loaded = json.loads(buildings_raw)
-        except Exception:
-            buildings_loaded = {}
-        buildings, migrated = _normalize_buildings(buildings_loaded)
+        buildings, _occ, ne, migrated = _decode_city_state(buildings_raw)
 
         if building_id not in buildings:
             raise HTTPException(status_code=404, detail="Building not found")
 
         # lazy completion for consistency
-        _finish_upgrades_if_due(now, buildings)
+        _maybe_finish_upgrades(now, buildings, ne)
 
+        gold_b, wood_b, _gems_b, lc_b = resources_raw
         resources = {
-            "gold": _safe_float(resources_raw.get("gold"), 0.0),
-            "wood": _safe_float(resources_raw.get("wood"), 0.0),
-            "last_collect": _safe_float(resources_raw.get("last_collect"), now),
+            "gold": _safe_float(gold_b, 0.0),
+            "wood": _safe_float(wood_b, 0.0),
+            "last_collect": _safe_float(lc_b, now),
         }
 
         b = buildings[building_id]
@@ -835,30 +1300,28 @@ async def upgrade_building(req: Request, user_id: str, request: UpgradeRequest):
         if b.get("upgrade_end") is not None:
             raise HTTPException(status_code=400, detail="Upgrade already running")
 
-        cfg = BUILDING_CONFIG[b_type]
+        max_level, upgrade_costs, upgrade_durations = _BCFG[b_type]
         current_level = int(b.get("level") or 1)
         next_level = current_level + 1
 
-        if next_level > int(cfg["max_level"]):
+        if next_level > max_level:
             raise HTTPException(status_code=400, detail="Max level reached")
 
         try:
-            cost_gold = float(cfg["upgrade_cost_gold"][next_level - 1])
-            duration = float(cfg["upgrade_duration"][next_level - 1])
+            cost_gold = upgrade_costs[next_level - 1]
+            duration = upgrade_durations[next_level - 1]
         except Exception:
             raise HTTPException(status_code=500, detail="Invalid building config")
 
         if not _can_afford(cost_gold, resources):
             raise HTTPException(status_code=400, detail="Not enough gold")
 
-        _charge_gold(cost_gold, resources)
         b["upgrade_start"] = now
         b["upgrade_end"] = now + duration
 
-        pipe = redis_client.pipeline()
-        pipe.hset(player_key, mapping={"gold": resources["gold"]})
-        pipe.set(city_key, json.dumps(buildings))
-        await pipe.execute()
+        charge = 0.0 if _is_unlimited() else float(cost_gold)
+        if not await _charge_and_set_city(player_key, city_key, charge, _dumps_city(buildings)):
+            raise HTTPException(status_code=400, detail="Not enough gold")
 
         if DEBUG_DUMP:
             log.info(
@@ -892,8 +1355,9 @@ async def place_building(req: Request, user_id: str, request: PlaceRequest):
         raise HTTPException(status_code=403, detail="Not allowed to modify this city")
 
     building_type = request.building_type
-    x = int(request.x)
-    y = int(request.y)
+    # pydantic already validated these as ints; no re-cast needed
+    x = request.x
+    y = request.y
     rotation = request.rotation
 
     if building_type not in BUILDING_CONFIG:
@@ -904,44 +1368,41 @@ async def place_building(req: Request, user_id: str, request: PlaceRequest):
 
     player_key = _player_key(user_id)
     city_key = _city_key(city_id)
+    world_key = _world_key(city_id)
 
     async with UserLock(user_id):
-        buildings_raw = await redis_client.get(city_key)
-        resources_raw = await redis_client.hgetall(player_key)
+        # === NEW: player + city + world in one pipelined round-trip
+        resources_raw, buildings_raw, world, world_created = await _load_player_state(user_id, city_id)
 
         if not buildings_raw or not resources_raw:
             raise HTTPException(status_code=404, detail="Player not found")
 
-        # === NEW: load world (radius)
-        world = await _load_world(city_id)
-
         # world bounds check (including footprint)
         if not _footprint_fits_world(x, y, building_type, world, rotation):
             raise HTTPException(status_code=400, detail="Out of world bounds")
 
-        try:
-            buildings_loaded = json.loads(buildings_raw)
-        except Exception:
-            buildings_loaded = {}
-        buildings, migrated = _normalize_buildings(buildings_loaded)
+        buildings, occ, ne, migrated = _decode_city_state(buildings_raw)
 
         # finish upgrades (consistency)
-        _finish_upgrades_if_due(now, buildings)
+        _maybe_finish_upgrades(now, buildings, ne)
 
+        gold_b, wood_b, _gems_b, lc_b = resources_raw
         resources = {
-            "gold": _safe_float(resources_raw.get("gold"), 0.0),
-            "wood": _safe_float(resources_raw.get("wood"), 0.0),
-            "last_collect": _safe_float(resources_raw.get("last_collect"), now),
+            "gold": _safe_float(gold_b, 0.0),
+            "wood": _safe_float(wood_b, 0.0),
+            "last_collect": _safe_float(lc_b, now),
         }
 
         # === NEW: footprint collision check (instead of x/y single-tile check)
-        if _footprint_collides(buildings, x, y, building_type, rotation):
+        # the packed-tile set persisted in the blob makes this O(footprint);
+        # pre-occ blobs rebuild it once and re-save it below
+        occupied = occ if occ is not None else _occupied_tiles_packed(buildings)
+        if _footprint_collides(occupied, x, y, building_type, rotation):
             raise HTTPException(status_code=400, detail="Position is occupied")
 
-        cfg = BUILDING_CONFIG[building_type]
         # build cost: use "level 2 cost" as before
         try:
-            build_cost_gold = float(cfg["upgrade_cost_gold"][1])
+            build_cost_gold = _BCFG[building_type][1][1]
         except Exception:
             build_cost_gold = 100.0
 
@@ -949,7 +1410,7 @@ async def place_building(req: Request, user_id: str, request: PlaceRequest):
             raise HTTPException(status_code=400, detail="Not enough gold to build")
 
         new_id = f"{building_type}_{int(now * 1000)}"
-        rot = int(rotation) if rotation is not None else 0
+        rot = rotation if rotation is not None else 0
         fp_w, fp_h = _get_footprint_for_type(building_type)
 
         buildings[new_id] = {
@@ -963,12 +1424,15 @@ async def place_building(req: Request, user_id: str, request: PlaceRequest):
             "footprint": {"w": fp_w, "h": fp_h},
         }
 
-        _charge_gold(build_cost_gold, resources)
+        new_tiles = frozenset(
+            _pack_tile(tx, ty) for tx, ty in _tiles_for_footprint(x, y, fp_w, fp_h, rot)
+        )
 
-        pipe = redis_client.pipeline()
-        pipe.hset(player_key, mapping={"gold": resources["gold"]})
-        pipe.set(city_key, json.dumps(buildings))
-        await pipe.execute()
+        charge = 0.0 if _is_unlimited() else float(build_cost_gold)
+        if not await _charge_and_set_city(player_key, city_key, charge, _dumps_city(buildings, occupied | new_tiles)):
+            raise HTTPException(status_code=400, detail="Not enough gold to build")
+        if world_created:
+            await redis_client.hset(world_key, mapping=world)
 
         if DEBUG_DUMP:
             fp_w, fp_h = _get_footprint_for_type(building_type)
@@ -1009,20 +1473,19 @@ async def demolish_building(req: Request, user_id: str, request: DemolishRequest
     city_key = _city_key(city_id)
 
     async with UserLock(user_id):
-        buildings_raw = await redis_client.get(city_key)
-        resources_raw = await redis_client.hgetall(player_key)
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.get(city_key)
+        pipe.hmget(player_key, *_RESOURCE_FIELDS)
+        buildings_raw, resources_raw = await pipe.execute()
+        resources_raw = _resources_or_none(resources_raw)
 
         if not buildings_raw or not resources_raw:
             raise HTTPException(status_code=404, detail="Player not found")
 
-        try:
-            buildings_loaded = json.loads(buildings_raw)
-        except Exception:
-            buildings_loaded = {}
-        buildings, migrated = _normalize_buildings(buildings_loaded)
+        buildings, occ, ne, migrated = _decode_city_state(buildings_raw)
 
         # finish upgrades (consistency)
-        _finish_upgrades_if_due(now, buildings)
+        _maybe_finish_upgrades(now, buildings, ne)
 
         if building_id not in buildings:
             raise HTTPException(status_code=404, detail="Building not found")
@@ -1034,31 +1497,27 @@ async def demolish_building(req: Request, user_id: str, request: DemolishRequest
         if b_type == "townhall":
             raise HTTPException(status_code=400, detail="Townhall cannot be demolished")
 
-        resources = {
-            "gold": _safe_float(resources_raw.get("gold"), 0.0),
-            "wood": _safe_float(resources_raw.get("wood"), 0.0),
-            "last_collect": _safe_float(resources_raw.get("last_collect"), now),
-        }
-
         # refund (25% of build cost) same logic as /place
         refund_gold = 0.0
-        if b_type in BUILDING_CONFIG:
+        if b_type in _BCFG:
             try:
-                base_cost = float(BUILDING_CONFIG[b_type]["upgrade_cost_gold"][1])
+                base_cost = _BCFG[b_type][1][1]
             except Exception:
                 base_cost = 100.0
             refund_gold = round(base_cost * 0.25, 2)
 
-        # delete
+        # delete (dropping its tiles from the persisted occupancy set)
+        if occ is not None:
+            occ = occ - frozenset(_pack_tile(tx, ty) for tx, ty in _building_occupied_tiles(b))
         del buildings[building_id]
 
         # refund (unless unlimited; in unlimited mode it's not needed but harmless)
-        if not _is_unlimited():
-            resources["gold"] = float(resources["gold"]) + float(refund_gold)
-
-        pipe = redis_client.pipeline()
-        pipe.hset(player_key, mapping={"gold": resources["gold"]})
-        pipe.set(city_key, json.dumps(buildings))
+        # atomic: the refund and the blob without the building go together
+        pipe = redis_client.pipeline(transaction=True)
+        if not _is_unlimited() and refund_gold:
+            # atomic add: no read-modify-write of the gold field
+            pipe.hincrbyfloat(player_key, "gold", float(refund_gold))
+        pipe.set(city_key, _dumps_city(buildings, occ))
         await pipe.execute()
 
         if DEBUG_DUMP:
@@ -1081,22 +1540,42 @@ class ExpandRequest(BaseModel):
     steps: int = 1  # default expand by 1 ring (one row on each side)
 
 
+# Prefix sums of the per-ring gold cost, built once at import: a cost query
+# becomes one array subtraction instead of a pow-per-step Python loop. The
+# table stops where 1.65**rr would overflow a double (~ring 1400, far past
+# the 2000-radius dev cap); beyond it the legacy loop keeps the old
+# failure mode.
+_EXPAND_BASE_GOLD = 250.0
+
+
+def _build_cum_expand_gold() -> Tuple[float, ...]:
+    acc = 0.0
+    out = [0.0]
+    for rr in range(1400):
+        acc += _EXPAND_BASE_GOLD * (1.65 ** max(0, rr - 3))
+        out.append(acc)
+    return tuple(out)
+
+
+_CUM_EXPAND_GOLD = _build_cum_expand_gold()
+
+
 def _expand_cost_gold(current_radius: int, steps: int = 1) -> float:
     """
     Exponential-ish cost curve for expansions (future microtransactions friendly).
     You requested: not linear, grows faster.
     This is a placeholder formula; can be replaced later.
     """
-    # base cost for radius 3->4
-    base = 250.0
     r = max(0, int(current_radius))
     s = max(1, int(steps))
-    # geometric growth
+    hi = r + s
+    if hi < len(_CUM_EXPAND_GOLD):
+        return round(_CUM_EXPAND_GOLD[hi] - _CUM_EXPAND_GOLD[r], 2)
     # cost for each step: base * (1.65 ** (r-3))
     total = 0.0
     for i in range(s):
         rr = r + i
-        total += base * (1.65 ** max(0, rr - 3))
+        total += _EXPAND_BASE_GOLD * (1.65 ** max(0, rr - 3))
     return round(total, 2)
 
 
@@ -1112,7 +1591,7 @@ async def expand_world(req: Request, user_id: str, body: ExpandRequest):
     if not await can_modify_city(user_id, city_id):
         raise HTTPException(status_code=403, detail="Not allowed to modify this city")
 
-    steps = int(body.steps or 1)
+    steps = body.steps or 1
     if steps < 1:
         steps = 1
     if steps > 50:
@@ -1122,17 +1601,17 @@ async def expand_world(req: Request, user_id: str, body: ExpandRequest):
     world_key = _world_key(city_id)
 
     async with UserLock(user_id):
-        resources_raw = await redis_client.hgetall(player_key)
+        resources_raw, world = await _load_player_world(user_id, city_id)
         if not resources_raw:
             raise HTTPException(status_code=404, detail="Player not found")
 
-        world = await _load_world(city_id)
         r = int(world.get("radius") or DEFAULT_WORLD_RADIUS)
 
+        gold_b, wood_b, _gems_b, lc_b = resources_raw
         resources = {
-            "gold": _safe_float(resources_raw.get("gold"), 0.0),
-            "wood": _safe_float(resources_raw.get("wood"), 0.0),
-            "last_collect": _safe_float(resources_raw.get("last_collect"), now),
+            "gold": _safe_float(gold_b, 0.0),
+            "wood": _safe_float(wood_b, 0.0),
+            "last_collect": _safe_float(lc_b, now),
         }
 
         cost = _expand_cost_gold(r, steps)
@@ -1145,9 +1624,10 @@ async def expand_world(req: Request, user_id: str, body: ExpandRequest):
         world["radius"] = int(r + steps)
         world["updated_at"] = now
 
-        pipe = redis_client.pipeline()
+        # atomic: the gold charge and the new radius go together
+        pipe = redis_client.pipeline(transaction=True)
         pipe.hset(player_key, mapping={"gold": resources["gold"]})
-        pipe.set(world_key, json.dumps(world))
+        pipe.hset(world_key, mapping={"radius": world["radius"], "updated_at": now})
         await pipe.execute()
 
     return {
@@ -1179,27 +1659,32 @@ async def shop_credit_gems(req: Request, body: CreditGemsRequest):
     player_key = _player_key(user_id)
 
     async with UserLock(user_id):
-        # idempotency check
+        # idempotency check, batched with the player read: the stored
+        # response and the resources come back in one round-trip, and the
+        # resources are simply discarded on a replay hit
         idk = _idempo_key(user_id, "credit_gems", idem)
-        existing = await redis_client.get(idk)
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.get(idk)
+        pipe.hmget(player_key, *_RESOURCE_FIELDS)
+        existing, resources_vals = await pipe.execute()
         if existing:
             try:
-                return json.loads(existing)
+                return orjson.loads(existing)
             except Exception:
                 pass
 
-        resources_raw = await redis_client.hgetall(player_key)
+        resources_raw = _resources_or_none(resources_vals)
         if not resources_raw:
             raise HTTPException(status_code=404, detail="Player not found")
 
-        cur_gems = _safe_int(resources_raw.get("gems"), 0)
-        new_gems = cur_gems + int(body.gems)
+        cur_gems = _safe_int(resources_raw[2], 0)
+        new_gems = cur_gems + body.gems
 
         entry = {
-            "id": uuid.uuid4().hex,
+            "id": secrets.token_hex(16),
             "type": "credit",
             "reason": "purchase_gems",
-            "delta": {"gems": int(body.gems)},
+            "delta": {"gems": body.gems},
             "meta": {
                 "provider": body.provider,
                 "purchase_id": body.purchase_id,
@@ -1211,17 +1696,17 @@ async def shop_credit_gems(req: Request, body: CreditGemsRequest):
         resp = {
             "message": "Gems credited",
             "user_id": user_id,
-            "gems_added": int(body.gems),
+            "gems_added": body.gems,
             "gems": int(new_gems),
             "server_time": now,
         }
 
+        entry_b = orjson.dumps(entry)
         pipe = redis_client.pipeline(transaction=True)
         pipe.hset(player_key, mapping={"gems": new_gems})
-        pipe.lpush(_ledger_key(user_id), json.dumps(entry))
-        pipe.ltrim(_ledger_key(user_id), 0, 999)
-        pipe.set(idk, json.dumps(resp), ex=60 * 60 * 24 * 7)
-        await pipe.execute()
+        pipe.xadd(_ledger_key(user_id), {"e": entry_b}, maxlen=1000, approximate=True)
+        pipe.set(idk, orjson.dumps(resp), ex=60 * 60 * 24 * 7)
+        await _execute_with_ledger_migration(pipe, user_id, entry_b)
 
     return resp
 
@@ -1292,9 +1777,7 @@ async def dev_reset(req: Request, user_id: str, body: DevResetRequest):
         city_key = _city_key(city_id)
         world_key = _world_key(city_id) 
         if body.wipe:
-            await redis_client.delete(player_key)
-            await redis_client.delete(city_key)
-            await redis_client.delete(world_key)
+            await redis_client.unlink(player_key, city_key, world_key)
 
         if _is_unlimited():
             resources = {"gold": DEV_DEFAULT_GOLD, "wood": DEV_DEFAULT_WOOD, "gems": DEV_DEFAULT_GEMS, "last_collect": now}
@@ -1304,10 +1787,10 @@ async def dev_reset(req: Request, user_id: str, body: DevResetRequest):
         buildings = _default_city_buildings()
         world = _default_world()
 
-        pipe = redis_client.pipeline()
+        pipe = redis_client.pipeline(transaction=False)
         pipe.hset(player_key, mapping=resources)
-        pipe.set(city_key, json.dumps(buildings))
-        pipe.set(world_key, json.dumps(world))
+        pipe.set(city_key, _DEFAULT_BUILDINGS_BLOB)
+        pipe.hset(world_key, mapping=world)
         await pipe.execute()
 
     log.info(f"rid={req.state.rid} DEV reset user_id={user_id} wipe={body.wipe} unlimited={_is_unlimited()}")
@@ -1337,34 +1820,46 @@ async def dev_grant(req: Request, user_id: str, body: DevGrantRequest):
 
     async with UserLock(user_id):
         player_key = _player_key(user_id)
-        resources_raw = await redis_client.hgetall(player_key)
+        resources_raw = _resources_or_none(await redis_client.hmget(player_key, *_RESOURCE_FIELDS))
         if not resources_raw:
             raise HTTPException(status_code=404, detail="Player not found")
 
-        cur_gold = _safe_float(resources_raw.get("gold"), 0.0)
-        cur_wood = _safe_float(resources_raw.get("wood"), 0.0)
-        cur_gems = _safe_int(resources_raw.get("gems"), 0)
+        cur_gold = _safe_float(resources_raw[0], 0.0)
+        cur_wood = _safe_float(resources_raw[1], 0.0)
+        cur_gems = _safe_int(resources_raw[2], 0)
 
         g = body.gold
         w = body.wood
         gems = body.gems
 
         if mode == "add":
+            # server-side atomic increments: only the granted fields are
+            # touched, and nothing read-modify-writes the untouched ones
+            pipe = redis_client.pipeline(transaction=True)
             if g is not None:
                 cur_gold += float(g)
+                pipe.hincrbyfloat(player_key, "gold", float(g))
             if w is not None:
                 cur_wood += float(w)
+                pipe.hincrbyfloat(player_key, "wood", float(w))
             if gems is not None:
                 cur_gems += int(gems)
+                pipe.hincrby(player_key, "gems", int(gems))
+            if len(pipe):
+                await pipe.execute()
         else:
+            mapping: Dict[str, Any] = {}
             if g is not None:
                 cur_gold = float(g)
+                mapping["gold"] = cur_gold
             if w is not None:
                 cur_wood = float(w)
+                mapping["wood"] = cur_wood
             if gems is not None:
                 cur_gems = int(gems)
-
-        await redis_client.hset(player_key, mapping={"gold": cur_gold, "wood": cur_wood, "gems": cur_gems})
+                mapping["gems"] = cur_gems
+            if mapping:
+                await redis_client.hset(player_key, mapping=mapping)
 
     log.info(f"rid={req.state.rid} DEV grant user_id={user_id} mode={mode} gold={body.gold} wood={body.wood}")
     return {
@@ -1392,9 +1887,7 @@ async def dev_wipe(req: Request, user_id: str):
     now = time.time()
 
     async with UserLock(user_id):
-        await redis_client.delete(_player_key(user_id))
-        await redis_client.delete(_city_key(user_id))
-        await redis_client.delete(_world_key(user_id))
+        await redis_client.unlink(_player_key(user_id), _city_key(user_id), _world_key(user_id))
 
     log.info(f"rid={req.state.rid} DEV wipe user_id={user_id}")
     return {"status": "ok", "message": "Wiped", "user_id": user_id, "server_time": now}
@@ -1432,7 +1925,7 @@ async def dev_world_set_radius(
         world = await _load_world(city_id)
         world["radius"] = int(r)
         world["updated_at"] = now
-        await redis_client.set(_world_key(city_id), json.dumps(world))
+        await redis_client.hset(_world_key(city_id), mapping={"radius": int(r), "updated_at": now})
 
     log.info(f"rid={req.state.rid} DEV set_radius user_id={user_id} radius={r}")
     return {"status": "ok", "user_id": user_id, "world": world, "server_time": now}
@@ -1449,7 +1942,7 @@ async def expand_world_gems(req: Request, user_id: str, body: ExpandGemsRequest)
         raise HTTPException(status_code=403, detail="Not allowed to modify this city")
 
 
-    steps = int(body.steps or 1)
+    steps = body.steps or 1
     if steps < 1:
         steps = 1
     if steps > 50:
@@ -1463,25 +1956,35 @@ async def expand_world_gems(req: Request, user_id: str, body: ExpandGemsRequest)
     world_key = _world_key(city_id)
 
     async with UserLock(user_id):
-        # idempotency check
+        # idempotency check, batched with the player + world reads
         idk = _idempo_key(user_id, "expand_gems", idem)
-        existing = await redis_client.get(idk)
-        if existing:
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.get(idk)
+        pipe.hmget(player_key, *_RESOURCE_FIELDS)
+        pipe.hgetall(world_key)
+        existing, resources_vals, world_raw = await pipe.execute(raise_on_error=False)
+        if existing and not isinstance(existing, Exception):
             # return the stored response (exactly the same)
             try:
-                return json.loads(existing)
+                return orjson.loads(existing)
             except Exception:
                 # fallthrough (should not happen)
                 pass
 
-        resources_raw = await redis_client.hgetall(player_key)
+        if isinstance(resources_vals, Exception):
+            raise resources_vals
+        resources_raw = _resources_or_none(resources_vals)
         if not resources_raw:
             raise HTTPException(status_code=404, detail="Player not found")
 
-        world = await _load_world(city_id)
+        if isinstance(world_raw, Exception) or not world_raw:
+            world = await _load_world(city_id)
+        else:
+            world = _parse_world_hash(world_raw)
+
         r = int(world.get("radius") or DEFAULT_WORLD_RADIUS)
 
-        cur_gems = _safe_int(resources_raw.get("gems"), 0)
+        cur_gems = _safe_int(resources_raw[2], 0)
         cost = _expand_cost_gems(r, steps)
 
         if cur_gems < cost:
@@ -1493,7 +1996,7 @@ async def expand_world_gems(req: Request, user_id: str, body: ExpandGemsRequest)
 
         # ledger entry
         entry = {
-            "id": uuid.uuid4().hex,
+            "id": secrets.token_hex(16),
             "type": "spend",
             "reason": "expand_world",
             "delta": {"gems": -cost},
@@ -1510,13 +2013,13 @@ async def expand_world_gems(req: Request, user_id: str, body: ExpandGemsRequest)
             "server_time": now,
         }
 
+        entry_b = orjson.dumps(entry)
         pipe = redis_client.pipeline(transaction=True)
         pipe.hset(player_key, mapping={"gems": cur_gems})
-        pipe.set(world_key, json.dumps(world))
-        pipe.lpush(_ledger_key(user_id), json.dumps(entry))
-        pipe.ltrim(_ledger_key(user_id), 0, 999)
-        pipe.set(idk, json.dumps(resp), ex=60 * 60 * 24 * 7)  # keep idempotency 7 days
-        await pipe.execute()
+        pipe.hset(world_key, mapping={"radius": world["radius"], "updated_at": now})
+        pipe.xadd(_ledger_key(user_id), {"e": entry_b}, maxlen=1000, approximate=True)
+        pipe.set(idk, orjson.dumps(resp), ex=60 * 60 * 24 * 7)  # keep idempotency 7 days
+        await _execute_with_ledger_migration(pipe, user_id, entry_b)
 
     return resp
 
@@ -1540,29 +2043,27 @@ async def speedup_upgrade(req: Request, user_id: str, body: SpeedupUpgradeReques
     city_key = _city_key(city_id)
 
     async with UserLock(user_id):
-        # idempotency
+        # idempotency check + state load in one batch
         idk = _idempo_key(user_id, "speedup_upgrade", idem)
-        existing = await redis_client.get(idk)
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.get(idk)
+        pipe.hmget(player_key, *_RESOURCE_FIELDS)
+        pipe.get(city_key)
+        existing, resources_vals, buildings_raw = await pipe.execute()
         if existing:
             try:
-                return json.loads(existing)
+                return orjson.loads(existing)
             except Exception:
                 pass
 
-        # load state
-        resources_raw = await redis_client.hgetall(player_key)
-        buildings_raw = await redis_client.get(city_key)
+        resources_raw = _resources_or_none(resources_vals)
         if not resources_raw or not buildings_raw:
             raise HTTPException(status_code=404, detail="Player not found")
 
-        try:
-            buildings_loaded = json.loads(buildings_raw)
-        except Exception:
-            buildings_loaded = {}
-        buildings, _ = _normalize_buildings(buildings_loaded)
+        buildings, _occ, ne, _migrated = _decode_city_state(buildings_raw)
 
         # finish due upgrades first (consistency)
-        _finish_upgrades_if_due(now, buildings)
+        _maybe_finish_upgrades(now, buildings, ne)
 
         bid = body.building_id
         if bid not in buildings:
@@ -1586,14 +2087,14 @@ async def speedup_upgrade(req: Request, user_id: str, body: SpeedupUpgradeReques
         if mode == "reduce":
             if body.seconds is None:
                 raise HTTPException(status_code=422, detail="seconds is required for mode=reduce")
-            reduce_sec = max(1, int(body.seconds))
+            reduce_sec = max(1, body.seconds)
             reduce_sec = min(reduce_sec, int(math.ceil(remaining)))
         else:
             reduce_sec = int(math.ceil(remaining))
 
         cost = _speedup_cost_gems(reduce_sec)
 
-        cur_gems = _safe_int(resources_raw.get("gems"), 0)
+        cur_gems = _safe_int(resources_raw[2], 0)
         if cur_gems < cost:
             raise HTTPException(status_code=400, detail=f"Not enough gems (cost {cost})")
 
@@ -1610,7 +2111,7 @@ async def speedup_upgrade(req: Request, user_id: str, body: SpeedupUpgradeReques
 
         # ledger entry
         entry = {
-            "id": uuid.uuid4().hex,
+            "id": secrets.token_hex(16),
             "type": "spend",
             "reason": "speedup_upgrade",
             "delta": {"gems": -int(cost)},
@@ -1640,12 +2141,12 @@ async def speedup_upgrade(req: Request, user_id: str, body: SpeedupUpgradeReques
         }
 
         # atomic save
+        entry_b = orjson.dumps(entry)
         pipe = redis_client.pipeline(transaction=True)
         pipe.hset(player_key, mapping={"gems": cur_gems})
-        pipe.set(city_key, json.dumps(buildings))
-        pipe.lpush(_ledger_key(user_id), json.dumps(entry))
-        pipe.ltrim(_ledger_key(user_id), 0, 999)
-        pipe.set(idk, json.dumps(resp), ex=60 * 60 * 24 * 7)
-        await pipe.execute()
+        pipe.set(city_key, _dumps_city(buildings))
+        pipe.xadd(_ledger_key(user_id), {"e": entry_b}, maxlen=1000, approximate=True)
+        pipe.set(idk, orjson.dumps(resp), ex=60 * 60 * 24 * 7)
+        await _execute_with_ledger_migration(pipe, user_id, entry_b)
 
     return resp
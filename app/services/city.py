@@ -1,20 +1,65 @@
 # app/services/city.py
 
-import json
+import asyncio
+import os
 import time
-import uuid
+
+import orjson
+from redis.exceptions import NoScriptError, ResponseError
+
 from app.redis_client import redis_client
 
 INVITE_TTL_SECONDS = 60 * 60 * 24  # 24h
 
+# In-process TTL caches for the authorization hot path: city meta changes
+# rarely (membership only via accept_invite, which invalidates below), so a
+# few seconds of staleness buys zero Redis round-trips on repeated checks.
+# Single-instance assumption — a multi-worker deploy would need keyspace
+# notifications to invalidate across processes.
+_CACHE_TTL_SECONDS = 5.0
+_CACHE_MAX_ENTRIES = 4096
+_meta_cache: dict = {}  # city_id -> (expires_at, meta)
+_role_cache: dict = {}  # (city_id, user_id) -> (expires_at, role or None)
+
+
+def _cache_put(cache: dict, key, value) -> None:
+    """Bounded insert: once the cache fills, sweep out expired entries and,
+    if everything is somehow still live, evict oldest-inserted (dict order)
+    so a long-lived process cannot accumulate entries without limit."""
+    if len(cache) >= _CACHE_MAX_ENTRIES:
+        now = time.monotonic()
+        for k in [k for k, v in cache.items() if v[0] <= now]:
+            del cache[k]
+        while len(cache) >= _CACHE_MAX_ENTRIES:
+            del cache[next(iter(cache))]
+    cache[key] = (time.monotonic() + _CACHE_TTL_SECONDS, value)
+
+# Coalescer for concurrent meta reads: when a popular city misses the cache
+# under load, only the first caller hits Redis and the rest await its future.
+_meta_inflight: dict = {}  # city_id -> asyncio.Future
+
 
 # -----------------------------------------------------------------------------
 # Redis keys
 # -----------------------------------------------------------------------------
+# city:{id}:meta is a HASH (city_id / owner_id / created_at) and membership
+# lives in the city:{id}:members HASH (user_id -> role). Adding a member is
+# one O(1) HSET instead of GET -> json -> mutate -> SET of a growing blob,
+# and concurrent accepts can no longer overwrite each other's member entry.
+# Legacy JSON-blob metas are migrated in place on first read.
+def _as_str(v):
+    """Replies come back as raw bytes (decode_responses=False)."""
+    return v.decode() if isinstance(v, bytes) else v
+
+
 def _city_meta_key(city_id: str) -> str:
     return f"city:{city_id}:meta"
 
 
+def _city_members_key(city_id: str) -> str:
+    return f"city:{city_id}:members"
+
+
 def _user_city_key(user_id: str) -> str:
     return f"user:{user_id}:city"
 
@@ -35,19 +80,16 @@ async def init_city_for_user(user_id: str) -> str:
     city_id = user_id
     meta_key = _city_meta_key(city_id)
 
-    exists = await redis_client.exists(meta_key)
-    if not exists:
-        meta = {
-            "city_id": city_id,
-            "owner_id": user_id,
-            "members": {
-                user_id: "owner",
-            },
-            "created_at": time.time(),
-        }
-        await redis_client.set(meta_key, json.dumps(meta))
-
-    await redis_client.set(_user_city_key(user_id), city_id)
+    # no EXISTS probe: every field is a pure function of user_id, so the
+    # writes are idempotent and go out unconditionally in one round-trip.
+    # HSETNX guards the two values that must survive re-login races:
+    # the original created_at and any pre-existing member role.
+    pipe = redis_client.pipeline(transaction=True)
+    pipe.hsetnx(meta_key, "created_at", time.time())
+    pipe.hset(meta_key, mapping={"city_id": city_id, "owner_id": user_id})
+    pipe.hsetnx(_city_members_key(city_id), user_id, "owner")
+    pipe.set(_user_city_key(user_id), city_id)
+    await pipe.execute()
     return city_id
 
 
@@ -60,74 +102,345 @@ async def get_city_id_for_user(user_id: str) -> str:
     return await init_city_for_user(user_id)
 
 
-async def get_city_meta(city_id: str) -> dict:
-    raw = await redis_client.get(_city_meta_key(city_id))
+async def _migrate_meta_blob(city_id: str) -> dict:
+    """One-time conversion of a legacy JSON meta blob into the hash layout."""
+    meta_key = _city_meta_key(city_id)
+    raw = await redis_client.get(meta_key)
     if not raw:
         raise ValueError(f"City meta not found for city_id={city_id}")
-    return json.loads(raw)
+    meta = orjson.loads(raw)
+    members = meta.get("members") or {}
 
+    pipe = redis_client.pipeline(transaction=True)
+    pipe.delete(meta_key)
+    pipe.hset(
+        meta_key,
+        mapping={
+            "city_id": meta.get("city_id") or city_id,
+            "owner_id": meta.get("owner_id") or "",
+            "created_at": meta.get("created_at") or 0.0,
+        },
+    )
+    if members:
+        pipe.hset(_city_members_key(city_id), mapping=members)
+    await pipe.execute()
+    return meta
 
-async def can_modify_city(user_id: str, city_id: str) -> bool:
-    meta = await get_city_meta(city_id)
 
-    if user_id == meta.get("owner_id"):
-        return True
+async def get_city_meta(city_id: str) -> dict:
+    hit = _meta_cache.get(city_id)
+    if hit is not None and hit[0] > time.monotonic():
+        return hit[1]
+
+    fut = _meta_inflight.get(city_id)
+    if fut is not None:
+        return await fut
+
+    fut = asyncio.get_running_loop().create_future()
+    _meta_inflight[city_id] = fut
+    try:
+        meta = await _fetch_city_meta(city_id)
+    except BaseException as e:
+        fut.set_exception(e)
+        fut.exception()  # mark retrieved: waiters still see it via await
+        raise
+    else:
+        fut.set_result(meta)
+        return meta
+    finally:
+        _meta_inflight.pop(city_id, None)
+
+
+async def _fetch_city_meta(city_id: str) -> dict:
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.hgetall(_city_meta_key(city_id))
+    pipe.hgetall(_city_members_key(city_id))
+    h, members = await pipe.execute(raise_on_error=False)
+
+    if isinstance(h, Exception):
+        # WRONGTYPE: legacy JSON blob, convert once
+        meta = await _migrate_meta_blob(city_id)
+    elif not h:
+        raise ValueError(f"City meta not found for city_id={city_id}")
+    else:
+        h = {_as_str(k): v for k, v in h.items()}
+        if isinstance(members, dict):
+            members = {_as_str(k): _as_str(v) for k, v in members.items()}
+        else:
+            members = {}
+        meta = {
+            "city_id": _as_str(h.get("city_id")) or city_id,
+            "owner_id": _as_str(h.get("owner_id")),
+            "members": members,
+            "created_at": float(h.get("created_at") or 0.0),
+        }
 
-    role = meta.get("members", {}).get(user_id)
-    return role == "editor"
+    _cache_put(_meta_cache, city_id, meta)
+    return meta
+
+
+async def can_modify_city(user_id: str, city_id: str) -> bool:
+    cache_key = (city_id, user_id)
+    hit = _role_cache.get(cache_key)
+    if hit is not None and hit[0] > time.monotonic():
+        return hit[1] in ("owner", "editor")
+
+    # fast path: one HGET, no JSON parsing
+    try:
+        role = _as_str(await redis_client.hget(_city_members_key(city_id), user_id))
+    except Exception:
+        role = None
+
+    if role is None:
+        # legacy blob, missing city, or plain non-member: the meta read
+        # migrates/validates and settles it
+        try:
+            meta = await get_city_meta(city_id)
+        except ValueError:
+            return False
+        if user_id == meta.get("owner_id"):
+            role = "owner"
+        else:
+            role = meta.get("members", {}).get(user_id)
+
+    _cache_put(_role_cache, cache_key, role)
+    return role in ("owner", "editor")
 
 
 # -----------------------------------------------------------------------------
 # INVITES
 # -----------------------------------------------------------------------------
+# Invite tokens need uniqueness, not key-derivation strength. Slicing 16
+# bytes out of a refilled os.urandom block amortizes the urandom syscall
+# over 256 tokens (uuid4 paid it on every call). Event-loop single-threaded,
+# so no locking around the cursor.
+_RAND_CHUNK = 4096
+_rand_pool = b""
+_rand_pos = 0
+
+
+def _rand_token() -> str:
+    global _rand_pool, _rand_pos
+    if _rand_pos + 16 > len(_rand_pool):
+        _rand_pool = os.urandom(_RAND_CHUNK)
+        _rand_pos = 0
+    tok = _rand_pool[_rand_pos:_rand_pos + 16].hex()
+    _rand_pos += 16
+    return tok
+
+
 async def create_invite(city_id: str, created_by: str, role: str = "editor") -> str:
     if role not in ("editor", "viewer"):
         raise ValueError("Invalid role")
 
-    token = uuid.uuid4().hex
+    # the city_id rides in the token so accept_invite can batch the invite
+    # and the city meta reads in one round-trip instead of two dependent GETs
+    token = f"{city_id}:{_rand_token()}"
+    now = time.time()
     payload = {
         "city_id": city_id,
         "role": role,
         "created_by": created_by,
-        "created_at": time.time(),
-        "expires_at": time.time() + INVITE_TTL_SECONDS,
+        "created_at": now,
+        "expires_at": now + INVITE_TTL_SECONDS,
     }
 
-    await redis_client.set(
-        _invite_key(token),
-        json.dumps(payload),
-        ex=INVITE_TTL_SECONDS,
-    )
+    # invites are 5 scalar fields — a hash skips JSON entirely on the accept
+    # hot path. Hashes have no single-command TTL, so HSET+EXPIRE share one
+    # pipelined round-trip.
+    invite_key = _invite_key(token)
+    pipe = redis_client.pipeline(transaction=True)
+    pipe.hset(invite_key, mapping=payload)
+    pipe.expire(invite_key, INVITE_TTL_SECONDS)
+    await pipe.execute()
     return token
 
 
+# Whole accept in one atomic round-trip for the modern layout (hash invite,
+# hash meta, city id embedded in the token). Returns false when the invite is
+# missing or the token hint disagrees with the payload, so the caller can
+# fall back to the stepwise path; raises WRONGTYPE for legacy JSON invites,
+# handled the same way. Same lazy SCRIPT LOAD pattern as app.main.
+_ACCEPT_INVITE_LUA = """
+local city_id = redis.call('HGET', KEYS[1], 'city_id')
+if not city_id or city_id ~= ARGV[2] then
+    return false
+end
+if redis.call('EXISTS', KEYS[2]) == 0 then
+    return 'NOCITY'
+end
+local existing = redis.call('HGET', KEYS[3], ARGV[1])
+if existing then
+    redis.call('SET', KEYS[4], city_id)
+    return {city_id, existing}
+end
+local role = redis.call('HGET', KEYS[1], 'role')
+redis.call('HSET', KEYS[3], ARGV[1], role)
+redis.call('SET', KEYS[4], city_id)
+redis.call('DEL', KEYS[1])
+return {city_id, role}
+"""
+_ACCEPT_INVITE_SHA = None
+
+
+async def _accept_invite_eval(keys, args):
+    global _ACCEPT_INVITE_SHA
+    if _ACCEPT_INVITE_SHA is None:
+        _ACCEPT_INVITE_SHA = await redis_client.script_load(_ACCEPT_INVITE_LUA)
+    try:
+        return await redis_client.evalsha(_ACCEPT_INVITE_SHA, len(keys), *keys, *args)
+    except NoScriptError:
+        _ACCEPT_INVITE_SHA = await redis_client.script_load(_ACCEPT_INVITE_LUA)
+        return await redis_client.evalsha(_ACCEPT_INVITE_SHA, len(keys), *keys, *args)
+
+
 async def accept_invite(token: str, user_id: str) -> str:
-    raw = await redis_client.get(_invite_key(token))
-    if not raw:
+    # current tokens are "<city_id>:<hex>", so invite, meta and the caller's
+    # current role come back in one batch; bare legacy tokens read stepwise
+    city_hint, sep, _ = token.partition(":")
+    invite_key = _invite_key(token)
+    user_city_key = _user_city_key(user_id)
+
+    if sep:
+        hint_meta_key = _city_meta_key(city_hint)
+        hint_members_key = _city_members_key(city_hint)
+        # fast path: one atomic EVALSHA settles the whole accept
+        try:
+            res = await _accept_invite_eval(
+                [invite_key, hint_meta_key, hint_members_key, user_city_key],
+                [user_id, city_hint],
+            )
+        except ResponseError:
+            res = None  # WRONGTYPE: legacy JSON invite, take the stepwise path
+        if res == b"NOCITY":
+            raise ValueError("City does not exist")
+        if res:
+            city_id = _as_str(res[0])
+            _meta_cache.pop(city_id, None)
+            _role_cache.pop((city_id, user_id), None)
+            return city_id
+        # invite missing, hint mismatch, or legacy layout → stepwise path
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.hgetall(invite_key)
+        pipe.hgetall(hint_meta_key)
+        pipe.hget(hint_members_key, user_id)
+        inv_h, meta_h, existing_role = await pipe.execute(raise_on_error=False)
+        if isinstance(inv_h, Exception):
+            # WRONGTYPE: invite predates the hash layout, stored as JSON
+            raw = await redis_client.get(invite_key)
+            invite = orjson.loads(raw) if raw else None
+        else:
+            invite = {_as_str(k): _as_str(v) for k, v in inv_h.items()} if inv_h else None
+    else:
+        # legacy bare token → legacy JSON-string invite
+        raw = await redis_client.get(invite_key)
+        invite = orjson.loads(raw) if raw else None
+        meta_h, existing_role = None, None
+
+    if not invite:
         raise ValueError("Invite not found or expired")
 
-    invite = json.loads(raw)
     city_id = invite["city_id"]
     role = invite["role"]
 
-    meta_key = _city_meta_key(city_id)
-    raw_meta = await redis_client.get(meta_key)
-    if not raw_meta:
-        raise ValueError("City does not exist")
-
-    meta = json.loads(raw_meta)
+    if sep and city_id != city_hint:
+        # token hint disagreed with the payload; the payload wins
+        meta_h, existing_role = None, None
+
+    if isinstance(meta_h, Exception) or not meta_h:
+        # legacy blob (WRONGTYPE) or no usable hint: get_city_meta
+        # migrates/validates and gives us membership in one place
+        try:
+            meta = await get_city_meta(city_id)
+        except ValueError:
+            raise ValueError("City does not exist")
+        existing_role = meta.get("members", {}).get(user_id)
+    elif isinstance(existing_role, Exception):
+        existing_role = None
 
     # already member → idempotent accept
-    if user_id in meta.get("members", {}):
-        await redis_client.set(_user_city_key(user_id), city_id)
+    if existing_role:
+        await redis_client.set(user_city_key, city_id)
         return city_id
 
-    meta["members"][user_id] = role
-
     pipe = redis_client.pipeline(transaction=True)
-    pipe.set(meta_key, json.dumps(meta))
-    pipe.set(_user_city_key(user_id), city_id)
-    pipe.delete(_invite_key(token))
+    pipe.hset(_city_members_key(city_id), user_id, role)
+    pipe.set(user_city_key, city_id)
+    pipe.delete(invite_key)
     await pipe.execute()
 
+    # membership changed: drop stale cache entries
+    _meta_cache.pop(city_id, None)
+    _role_cache.pop((city_id, user_id), None)
+
     return city_id
+
+
+async def accept_invites_batch(pairs: list) -> list:
+    """
+    Bulk accept for admin/onboarding flows (imported teams): N accepts in
+    three pipelined round-trips — all invites, all membership probes, all
+    writes — instead of N sequential accept_invite calls.
+
+    `pairs` is a list of (token, user_id). Returns a list aligned with it:
+    the joined city_id, or None when that invite is missing/expired, stored
+    in the legacy JSON layout, or its city does not exist.
+    """
+    if not pairs:
+        return []
+
+    # 1) every invite hash in one round-trip
+    pipe = redis_client.pipeline(transaction=False)
+    for token, _ in pairs:
+        pipe.hgetall(_invite_key(token))
+    raws = await pipe.execute(raise_on_error=False)
+
+    invites = []
+    for raw in raws:
+        # WRONGTYPE (legacy JSON invite) or empty → skipped, not migrated here
+        if isinstance(raw, Exception) or not raw:
+            invites.append(None)
+        else:
+            invites.append({_as_str(k): _as_str(v) for k, v in raw.items()})
+
+    # 2) city existence + caller's current role per accept, one round-trip
+    pipe = redis_client.pipeline(transaction=False)
+    for (_, user_id), inv in zip(pairs, invites):
+        if inv is None:
+            continue
+        pipe.exists(_city_meta_key(inv["city_id"]))
+        pipe.hget(_city_members_key(inv["city_id"]), user_id)
+    probes = iter(await pipe.execute(raise_on_error=False))
+
+    # 3) all writes in one transaction
+    results = []
+    touched = []
+    pipe = redis_client.pipeline(transaction=True)
+    for (token, user_id), inv in zip(pairs, invites):
+        if inv is None:
+            results.append(None)
+            continue
+        city_exists, existing_role = next(probes), next(probes)
+        if isinstance(city_exists, Exception) or not city_exists:
+            results.append(None)
+            continue
+        if isinstance(existing_role, Exception):
+            existing_role = None
+        city_id = inv["city_id"]
+        if existing_role:
+            # already member → idempotent accept, invite stays usable
+            pipe.set(_user_city_key(user_id), city_id)
+        else:
+            pipe.hset(_city_members_key(city_id), user_id, inv["role"])
+            pipe.set(_user_city_key(user_id), city_id)
+            pipe.delete(_invite_key(token))
+            touched.append((city_id, user_id))
+        results.append(city_id)
+    if len(pipe):
+        await pipe.execute()
+
+    for city_id, user_id in touched:
+        _meta_cache.pop(city_id, None)
+        _role_cache.pop((city_id, user_id), None)
+
+    return results